@@ -3,12 +3,15 @@
 # This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
 # See the file 'docs/LICENSE' for copying permission.
 
+import itertools
 import logging
 import os
 import re
+import sys
+import threading
 import time
 
-import xml.etree.ElementTree as ET
+import xml.etree.cElementTree as ET
 
 from cuckoo.common.config import config
 from cuckoo.common.exceptions import CuckooCriticalError
@@ -29,6 +32,25 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+# Default summary actions looked up by the file and registry key helpers of
+# Signature.
+FILE_ACTIONS = (
+    "file_opened", "file_written",
+    "file_read", "file_deleted",
+    "file_exists", "file_failed",
+)
+
+REGKEY_ACTIONS = (
+    "regkey_opened", "regkey_written",
+    "regkey_read", "regkey_deleted",
+)
+
+# check_key() looks at written keys first, which decides the key it returns.
+CHECK_REGKEY_ACTIONS = (
+    "regkey_written", "regkey_opened",
+    "regkey_read", "regkey_deleted",
+)
+
 class Auxiliary(object):
     """Base abstract class for auxiliary modules."""
 
@@ -68,6 +90,9 @@ class Machinery(object):
     # way.
     LABEL = "label"
 
+    # Maximum number of machines stopped concurrently during initialization.
+    stop_threads = 8
+
     def __init__(self):
         self.options = None
         self.db = Database()
@@ -76,6 +101,9 @@ class Machinery(object):
         # at each start.
         self.db.clean_machines()
 
+        # Last status written to the database for each machine.
+        self._last_status = {}
+
     @classmethod
     def init_once(cls):
         pass
@@ -105,31 +133,34 @@ class Machinery(object):
         @param module_name: module name.
         """
         machinery = self.options.get(module_name)
+
+        # Defaults shared by all machines that don't override them.
+        default_interface = machinery.get("interface")
+        default_ip = config("cuckoo:resultserver:ip")
+        default_port = None
+
+        # Collect all machines first so they're added in one transaction.
+        machines = []
         for vmname in machinery["machines"]:
             options = self.options.get(vmname)
 
             # If configured, use specific network interface for this
             # machine, else use the default value.
-            if options.get("interface"):
-                interface = options["interface"]
-            else:
-                interface = machinery.get("interface")
-
-            if options.get("resultserver_ip"):
-                ip = options["resultserver_ip"]
-            else:
-                ip = config("cuckoo:resultserver:ip")
+            interface = options.get("interface") or default_interface
+            ip = options.get("resultserver_ip") or default_ip
 
             if options.get("resultserver_port"):
                 port = options["resultserver_port"]
             else:
                 # The ResultServer port might have been dynamically changed,
-                # get it from the ResultServer singleton. Also avoid import
-                # recursion issues by importing ResultServer here.
-                from cuckoo.core.resultserver import ResultServer
-                port = ResultServer().port
-
-            self.db.add_machine(
+                # get it from the ResultServer singleton (once). Also avoid
+                # import recursion issues by importing ResultServer here.
+                if default_port is None:
+                    from cuckoo.core.resultserver import ResultServer
+                    default_port = ResultServer().port
+                port = default_port
+
+            machines.append(dict(
                 name=vmname,
                 label=options[self.LABEL],
                 ip=options.ip,
@@ -140,7 +171,9 @@ class Machinery(object):
                 snapshot=options.snapshot,
                 resultserver_ip=ip,
                 resultserver_port=port
-            )
+            ))
+
+        self.db.add_machines(machines)
 
     def _initialize_check(self):
         """Runs checks against virtualization software when a machine manager
@@ -155,6 +188,7 @@ class Machinery(object):
         except NotImplementedError:
             return
 
+        labels = []
         for machine in self.machines():
             # If this machine is already in the "correct" state, then we
             # go on to the next machine.
@@ -162,16 +196,48 @@ class Machinery(object):
                     self._status(machine.label) in [self.POWEROFF, self.ABORTED]:
                 continue
 
-            # This machine is currently not in its correct state, we're going
-            # to try to shut it down. If that works, then the machine is fine.
-            try:
-                self.stop(machine.label)
-            except CuckooMachineError as e:
-                raise CuckooCriticalError(
-                    "Please update your configuration. Unable to shut '%s' "
-                    "down or find the machine in its proper state: %s" %
-                    (machine.label, e)
-                )
+            labels.append(machine.label)
+
+        # These machines are currently not in their correct state, we're
+        # going to try to shut them down. If that works, then the machines
+        # are fine. Each stop may wait up to vm_state seconds for the machine
+        # to power off, so a few machines are stopped concurrently.
+        pending, lock, errors = iter(labels), threading.Lock(), {}
+
+        def stop():
+            while True:
+                with lock:
+                    label = next(pending, None)
+                if label is None:
+                    break
+
+                try:
+                    self.stop(label)
+                except Exception:
+                    errors[label] = sys.exc_info()
+
+        threads = []
+        for _ in xrange(min(self.stop_threads, len(labels))):
+            thread = threading.Thread(target=stop)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        for label in labels:
+            if label not in errors:
+                continue
+
+            exc_type, exc_value, exc_tb = errors[label]
+            if not issubclass(exc_type, CuckooMachineError):
+                raise exc_type, exc_value, exc_tb
+
+            raise CuckooCriticalError(
+                "Please update your configuration. Unable to shut '%s' "
+                "down or find the machine in its proper state: %s" %
+                (label, exc_value)
+            )
 
         if not config("cuckoo:timeouts:vm_state"):
             raise CuckooCriticalError(
@@ -236,6 +302,11 @@ class Machinery(object):
         @param label: virtual machine label
         @param status: new virtual machine status
         """
+        # Don't update the database while polling an unchanged status.
+        if self._last_status.get(label) == status:
+            return
+
+        self._last_status[label] = status
         self.db.set_machine_status(label, status)
 
     def start(self, label, task):
@@ -305,6 +376,14 @@ class LibVirtMachinery(Machinery):
     ERROR = "machete"
     ABORTED = "abort"
 
+    # Seconds during which a retrieved vm status is reused.
+    status_ttl = 0.25
+
+    # Thread running the default libvirt event loop, shared by all
+    # instances.
+    _event_thread = None
+    _event_lock = threading.Lock()
+
     def __init__(self):
         if not HAVE_LIBVIRT:
             raise CuckooDependencyError(
@@ -314,6 +393,19 @@ class LibVirtMachinery(Machinery):
 
         super(LibVirtMachinery, self).__init__()
 
+        # Single libvirt connection, opened on first use and reopened
+        # should libvirtd drop it.
+        self._conn = None
+        self.vms = None
+
+        # Per-label events set on domain lifecycle changes, and the number
+        # of lifecycle changes seen so far.
+        self._events = {}
+        self._generations = {}
+
+        # Recently retrieved statuses, label -> (timestamp, status).
+        self._status_cache = {}
+
     def initialize(self, module):
         """Initialize machine manager module. Override default to set proper
         connection string.
@@ -350,11 +442,9 @@ class LibVirtMachinery(Machinery):
                   "been turned off {0}".format(label)
             raise CuckooMachineError(msg)
 
-        conn = self._connect()
-
         vm_info = self.db.view_machine_by_label(label)
 
-        snapshot_list = self.vms[label].snapshotListNames(flags=0)
+        snapshot_list = self._domain(label).snapshotListNames(flags=0)
 
         # If a snapshot is configured try to use it.
         if vm_info.snapshot and vm_info.snapshot in snapshot_list:
@@ -362,30 +452,28 @@ class LibVirtMachinery(Machinery):
             log.debug("Using snapshot {0} for virtual machine "
                       "{1}".format(vm_info.snapshot, label))
             try:
-                vm = self.vms[label]
+                vm = self._domain(label)
                 snapshot = vm.snapshotLookupByName(vm_info.snapshot, flags=0)
-                self.vms[label].revertToSnapshot(snapshot, flags=0)
+                self._status_cache.pop(label, None)
+                vm.revertToSnapshot(snapshot, flags=0)
             except libvirt.libvirtError:
                 msg = "Unable to restore snapshot {0} on " \
                       "virtual machine {1}".format(vm_info.snapshot, label)
                 raise CuckooMachineError(msg)
-            finally:
-                self._disconnect(conn)
-        elif self._get_snapshot(label):
+        else:
             snapshot = self._get_snapshot(label)
+            if not snapshot:
+                raise CuckooMachineError("No snapshot found for virtual "
+                                         "machine {0}".format(label))
+
             log.debug("Using snapshot {0} for virtual machine "
                       "{1}".format(snapshot.getName(), label))
             try:
-                self.vms[label].revertToSnapshot(snapshot, flags=0)
+                self._status_cache.pop(label, None)
+                self._domain(label).revertToSnapshot(snapshot, flags=0)
             except libvirt.libvirtError:
                 raise CuckooMachineError("Unable to restore snapshot on "
                                          "virtual machine {0}".format(label))
-            finally:
-                self._disconnect(conn)
-        else:
-            self._disconnect(conn)
-            raise CuckooMachineError("No snapshot found for virtual machine "
-                                     "{0}".format(label))
 
         # Check state.
         self._wait_status(label, self.RUNNING)
@@ -402,18 +490,16 @@ class LibVirtMachinery(Machinery):
                                      "machine {0}".format(label))
 
         # Force virtual machine shutdown.
-        conn = self._connect()
         try:
-            if not self.vms[label].isActive():
+            if not self._domain(label).isActive():
                 log.debug("Trying to stop an already stopped machine %s. "
                           "Skip", label)
             else:
-                self.vms[label].destroy()  # Machete's way!
+                self._status_cache.pop(label, None)
+                self._domain(label).destroy()  # Machete's way!
         except libvirt.libvirtError as e:
             raise CuckooMachineError("Error stopping virtual machine "
                                      "{0}: {1}".format(label, e))
-        finally:
-            self._disconnect(conn)
         # Check state.
         self._wait_status(label, self.POWEROFF)
 
@@ -423,6 +509,11 @@ class LibVirtMachinery(Machinery):
 
         # Free handlers.
         self.vms = None
+        self._events = {}
+
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._disconnect(conn)
 
     def dump_memory(self, label, path):
         """Takes a memory dump.
@@ -430,24 +521,26 @@ class LibVirtMachinery(Machinery):
         """
         log.debug("Dumping memory for machine %s", label)
 
-        conn = self._connect()
         try:
             # Resolve permission issue as libvirt creates the file as
             # root/root in mode 0600, preventing us from reading it. This
             # supposedly still doesn't allow us to remove it, though..
             open(path, "wb").close()
-            self.vms[label].coreDump(path, flags=libvirt.VIR_DUMP_MEMORY_ONLY)
+            self._domain(label).coreDump(path, flags=libvirt.VIR_DUMP_MEMORY_ONLY)
         except libvirt.libvirtError as e:
             raise CuckooMachineError("Error dumping memory virtual machine "
                                      "{0}: {1}".format(label, e))
-        finally:
-            self._disconnect(conn)
 
     def _status(self, label):
         """Gets current status of a vm.
         @param label: virtual machine name.
         @return: status string.
         """
+        # Reuse a status that has been retrieved just now.
+        cached = self._status_cache.get(label)
+        if cached and time.time() - cached[0] < self.status_ttl:
+            return cached[1]
+
         log.debug("Getting status for %s", label)
 
         # Stetes mapping of python-libvirt.
@@ -461,14 +554,14 @@ class LibVirtMachinery(Machinery):
         # VIR_DOMAIN_CRASHED = 6
         # VIR_DOMAIN_PMSUSPENDED = 7
 
-        conn = self._connect()
+        # A lifecycle event during state() makes its outcome stale.
+        generation = self._generations.get(label)
+
         try:
-            state = self.vms[label].state(flags=0)
+            state = self._domain(label).state(flags=0)
         except libvirt.libvirtError as e:
             raise CuckooMachineError("Error getting status for virtual "
                                      "machine {0}: {1}".format(label, e))
-        finally:
-            self._disconnect(conn)
 
         if state:
             if state[0] == 1:
@@ -482,6 +575,8 @@ class LibVirtMachinery(Machinery):
 
         # Report back status.
         if status:
+            if self._generations.get(label) == generation:
+                self._status_cache[label] = time.time(), status
             self.set_status(label, status)
             return status
         else:
@@ -489,19 +584,73 @@ class LibVirtMachinery(Machinery):
                                      "{0}".format(label))
 
     def _connect(self):
-        """Connects to libvirt subsystem.
+        """Connects to libvirt subsystem. The connection is opened once and
+        reused until the machinery is shut down.
         @raise CuckooMachineError: when unable to connect to libvirt.
         """
+        if self._conn is not None:
+            return self._conn
+
         # Check if a connection string is available.
         if not self.dsn:
             raise CuckooMachineError("You must provide a proper "
                                      "connection string")
 
+        # Lifecycle events are only delivered on connections that have been
+        # opened after the event loop has been set up.
+        self._start_event_loop()
+
         try:
-            return libvirt.open(self.dsn)
+            self._conn = libvirt.open(self.dsn)
         except libvirt.libvirtError:
             raise CuckooMachineError("Cannot connect to libvirt")
 
+        try:
+            self._conn.registerCloseCallback(self._connection_closed, None)
+        except libvirt.libvirtError as e:
+            log.debug("Unable to register libvirt close callback: %s", e)
+
+        # The domain handles and their lifecycle events belonged to the
+        # connection that has been lost.
+        if self.vms:
+            log.info("Reconnected to libvirt, fetching machines again")
+            try:
+                self.vms = self._fetch_machines()
+            except Exception:
+                # Drop the new connection as well, so the next _connect()
+                # tries again rather than handing out the old handles.
+                conn, self._conn = self._conn, None
+                try:
+                    conn.close()
+                except libvirt.libvirtError:
+                    pass
+                raise
+        return self._conn
+
+    def _connection_closed(self, conn, reason, opaque):
+        """Callback for libvirt when the connection has been closed, e.g.,
+        because libvirtd has been restarted. The next _connect() reopens it.
+        """
+        if conn is not self._conn:
+            return
+
+        log.warning("Lost connection to libvirt (reason %s)", reason)
+        self._conn = None
+        self._status_cache.clear()
+
+        # Wake up waiters, so they check the status over the new connection.
+        for event in self._events.values():
+            event.set()
+
+    def _domain(self, label):
+        """Gets the domain handle of a virtual machine, reconnecting to
+        libvirt first if the connection has been lost.
+        @param label: virtual machine name.
+        @return: libvirt domain handle.
+        """
+        self._connect()
+        return self.vms[label]
+
     def _disconnect(self, conn):
         """Disconnects to libvirt subsystem.
         @raise CuckooMachineError: if cannot disconnect from libvirt.
@@ -515,38 +664,120 @@ class LibVirtMachinery(Machinery):
         """Fetch machines handlers.
         @return: dict with machine label as key and handle as value.
         """
+        # Fetch all domain handles at once rather than one lookup per vm.
+        try:
+            domains = self._connect().listAllDomains(0)
+        except libvirt.libvirtError:
+            raise CuckooMachineError("Cannot list domains")
+
+        domains = dict((domain.name(), domain) for domain in domains)
+
         vms = {}
         for vm in self.machines():
-            vms[vm.label] = self._lookup(vm.label)
+            if vm.label in domains:
+                vms[vm.label] = domains[vm.label]
+            else:
+                vms[vm.label] = self._lookup(vm.label)
+
+            self._register_events(vm.label, vms[vm.label])
         return vms
 
+    @classmethod
+    def _start_event_loop(cls):
+        """Runs the default libvirt event loop in a background thread. This
+        only happens once per process."""
+        with LibVirtMachinery._event_lock:
+            if LibVirtMachinery._event_thread is not None:
+                return
+
+            libvirt.virEventRegisterDefaultImpl()
+
+            def run():
+                while True:
+                    libvirt.virEventRunDefaultImpl()
+
+            thread = threading.Thread(target=run, name="libvirt-events")
+            thread.daemon = True
+            thread.start()
+            LibVirtMachinery._event_thread = thread
+
+    def _register_events(self, label, domain):
+        """Get notified about lifecycle changes of a virtual machine so
+        _wait_status() doesn't have to poll its status.
+        @param label: virtual machine name.
+        @param domain: libvirt domain handle.
+        """
+        # Reuse the event on reconnects, so current waiters keep working.
+        self._events.setdefault(label, threading.Event())
+        try:
+            self._connect().domainEventRegisterAny(
+                domain, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._lifecycle_event, label
+            )
+        except libvirt.libvirtError as e:
+            log.debug(
+                "Unable to register for lifecycle events of machine %s, "
+                "polling its status instead: %s", label, e
+            )
+            self._events.pop(label, None)
+
+    def _lifecycle_event(self, conn, domain, event, detail, label):
+        """Callback for libvirt domain lifecycle events."""
+        self._generations[label] = self._generations.get(label, 0) + 1
+        self._status_cache.pop(label, None)
+        if label in self._events:
+            self._events[label].set()
+
+    def _wait_status(self, label, *states):
+        """Waits for a vm status, woken up by libvirt lifecycle events.
+        @param label: virtual machine name.
+        @param state: virtual machine status, accepts multiple states as list.
+        @raise CuckooMachineError: if default waiting timeout expire.
+        """
+        event = self._events.get(label)
+        if event is None:
+            return super(LibVirtMachinery, self)._wait_status(label, *states)
+
+        deadline = time.time() + config("cuckoo:timeouts:vm_state")
+        while True:
+            # Clear before checking so an event fired in between isn't lost.
+            event.clear()
+            if self._status(label) in states:
+                return
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise CuckooMachineError(
+                    "Timeout hit while for machine %s to change status" % label
+                )
+
+            log.debug("Waiting for machine %s to switch to status %s",
+                      label, states)
+
+            # Still check every few seconds in case an event got lost.
+            event.wait(min(remaining, 5))
+
     def _lookup(self, label):
         """Search for a virtual machine.
         @param conn: libvirt connection handle.
         @param label: virtual machine name.
         @raise CuckooMachineError: if virtual machine is not found.
         """
-        conn = self._connect()
         try:
-            vm = conn.lookupByName(label)
+            vm = self._connect().lookupByName(label)
         except libvirt.libvirtError:
                 raise CuckooMachineError("Cannot find machine "
                                          "{0}".format(label))
-        finally:
-            self._disconnect(conn)
         return vm
 
     def _list(self):
         """List available virtual machines.
         @raise CuckooMachineError: if unable to list virtual machines.
         """
-        conn = self._connect()
         try:
-            names = conn.listDefinedDomains()
+            names = self._connect().listDefinedDomains()
         except libvirt.libvirtError:
             raise CuckooMachineError("Cannot list domains")
-        finally:
-            self._disconnect(conn)
         return names
 
     def _version_check(self):
@@ -574,9 +805,8 @@ class LibVirtMachinery(Machinery):
             return xml.findtext("./creationTime")
 
         snapshot = None
-        conn = self._connect()
         try:
-            vm = self.vms[label]
+            vm = self._domain(label)
 
             # Try to get the currrent snapshot, otherwise fallback on the latest
             # from config file.
@@ -586,14 +816,12 @@ class LibVirtMachinery(Machinery):
                 log.debug("No current snapshot, using latest snapshot")
 
                 # No current snapshot, try to get the last one from config file.
-                snapshot = sorted(vm.listAllSnapshots(flags=0),
-                                  key=_extract_creation_time,
-                                  reverse=True)[0]
+                snapshots = vm.listAllSnapshots(flags=0)
+                if snapshots:
+                    snapshot = max(snapshots, key=_extract_creation_time)
         except libvirt.libvirtError:
             raise CuckooMachineError("Unable to get snapshot for "
                                      "virtual machine {0}".format(label))
-        finally:
-            self._disconnect(conn)
 
         return snapshot
 
@@ -699,6 +927,34 @@ class Signature(object):
     # than calling the generic on_call(), call, e.g., on_call_CreateFile().
     on_call_dispatch = False
 
+    # Compiled regular expressions shared by all signatures, by pattern.
+    # Emptied once it holds regex_cache_size entries so that generated
+    # patterns can't make it grow without bounds.
+    regex_cache_size = 1024
+    _regex_cache = {}
+
+    # Regular expressions used by this signature. These are compiled once
+    # when the signature is loaded rather than when they're first checked.
+    patterns = []
+    _compiled_patterns = {}
+
+    # Subjects for check(): the getter providing the values and a function
+    # calling it with the pid and actions, returning an iterable of strings.
+    _check_subjects = {
+        "file": ("get_files", lambda get, pid, actions: get(pid, actions)),
+        "dll_loaded": ("get_dll_loaded", lambda get, pid, actions: get(pid)),
+        "command_line": ("get_command_lines", lambda get, pid, actions: get()),
+        "key": ("get_keys", lambda get, pid, actions: get(pid, actions)),
+        "mutex": ("get_mutexes", lambda get, pid, actions: get()),
+        "ip": ("get_net_hosts", lambda get, pid, actions: get()),
+        "domain": ("get_net_domains", lambda get, pid, actions: (
+            item["domain"] for item in get()
+        )),
+        "url": ("get_net_http", lambda get, pid, actions: (
+            item["uri"] for item in get()
+        )),
+    }
+
     def __init__(self, caller):
         """
         @param caller: calling object. Stores results in caller.results
@@ -707,6 +963,17 @@ class Signature(object):
         self.matched = False
         self._caller = caller
 
+        # Keys of the IOC marks added so far, used to skip duplicates.
+        self._ioc_marks = set()
+
+        # Behavior sections and their processes indexed by pid, looked up
+        # on first use.
+        self._behavior = {}
+        self._pid_index = {}
+
+        # Network sections, looked up on first use.
+        self._network = {}
+
         # These are set by the caller, they represent the process identifier
         # and call index respectively.
         self.pid = None
@@ -715,41 +982,144 @@ class Signature(object):
 
     @classmethod
     def init_once(cls):
-        pass
+        cls._compiled_patterns = {}
+        for pattern in cls.patterns:
+            try:
+                cls._compiled_patterns[pattern] = re.compile(
+                    pattern, re.IGNORECASE
+                )
+            except re.error as e:
+                log.warning(
+                    "Invalid pattern %r in signature %s: %s",
+                    pattern, cls.name, e
+                )
 
     def _check_value(self, pattern, subject, regex=False, all=False):
         """Checks a pattern against a given subject.
-        @param pattern: string or expression to check for.
-        @param subject: target of the check.
+        @param pattern: string or expression to check for. When regex is
+                        set, a list of expressions may be provided, which
+                        are joined into a single alternation.
+        @param subject: target of the check, either a single string or an
+                        iterable of strings, which is consumed lazily.
         @param regex: boolean representing if the pattern is a regular
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        ret = set()
         if regex:
-            exp = re.compile(pattern, re.IGNORECASE)
-            if isinstance(subject, list):
-                for item in subject:
-                    if exp.match(item):
-                        ret.add(item)
-            else:
-                if exp.match(subject):
-                    ret.add(subject)
+            if isinstance(pattern, (tuple, list)):
+                pattern = tuple(pattern)
+
+            exp = self._compiled_patterns.get(pattern)
+            if exp is None:
+                exp = Signature._regex_cache.get(pattern)
+            if exp is None:
+                if isinstance(pattern, tuple):
+                    exp = re.compile(
+                        "|".join("(?:%s)" % x for x in pattern), re.IGNORECASE
+                    )
+                else:
+                    exp = re.compile(pattern, re.IGNORECASE)
+
+                if len(Signature._regex_cache) >= self.regex_cache_size:
+                    Signature._regex_cache.clear()
+                Signature._regex_cache[pattern] = exp
+            match = exp.match
+        elif hasattr(subject, "__iter__"):
+            # Lists of subjects are compared case-insensitively. Lowercasing
+            # doesn't change the length of a string, so only lowercase the
+            # items that may actually be equal.
+            pattern, length = pattern.lower(), len(pattern)
+            match = lambda item: (
+                len(item) == length and item.lower() == pattern
+            )
         else:
-            if isinstance(subject, list):
-                for item in subject:
-                    if item.lower() == pattern.lower():
-                        ret.add(item)
-            else:
-                if subject == pattern:
-                    ret.add(subject)
+            match = lambda item: item == pattern
+
+        # Treat a single subject as a list of one.
+        if not hasattr(subject, "__iter__"):
+            subject = subject,
 
-        # Return all elements.
-        if all:
-            return list(ret)
         # Return only the first element, if available. Otherwise return None.
-        elif ret:
-            return ret.pop()
+        if not all:
+            for item in subject:
+                if match(item):
+                    return item
+            return
+
+        # Return all elements.
+        return list(set(item for item in subject if match(item)))
+
+    def check(self, kind, pattern, regex=False, all=False, pid=None,
+              actions=None):
+        """Checks a pattern against one of the subjects in _check_subjects,
+        e.g., "file" or "domain". The results don't change while the
+        signatures run, so the outcome is shared between all signatures of
+        the analysis that use the same getter.
+        @param kind: subject to check.
+        @param pattern: string or expression to check for.
+        @param regex: boolean representing if the pattern is a regular
+                      expression or not and therefore should be compiled.
+        @param all: return all matches rather than the first one.
+        @param pid: the process id to check, for subjects taken from the
+                    behavior summary. None for all processes.
+        @param actions: summary actions to check, for subjects that have
+                        them. None for the default actions.
+        @return: the (list of) matching element(s).
+        """
+        name, call = self._check_subjects[kind]
+        get = getattr(self, name)
+        cache = getattr(self._caller, "check_cache", None)
+
+        if isinstance(actions, list):
+            actions = tuple(actions)
+
+        # Signatures overriding the getter or the _check_subjects entry get
+        # their own cache entries.
+        source = call, getattr(get, "__func__", get)
+
+        if isinstance(pattern, list):
+            key = kind, source, pid, actions, tuple(pattern), regex, all
+        else:
+            key = kind, source, pid, actions, pattern, regex, all
+
+        try:
+            hash(key)
+        except TypeError:
+            cache = None
+
+        if not isinstance(cache, dict):
+            return self._check_value(
+                pattern, call(get, pid, actions), regex, all
+            )
+
+        if key in cache:
+            pass
+        elif not regex and isinstance(pattern, basestring):
+            index_key = kind, source, pid, actions
+            if index_key not in cache:
+                cache[index_key] = self._index_values(call(get, pid, actions))
+
+            matches = cache[index_key].get(pattern.lower(), ())
+            if all:
+                cache[key] = list(set(matches))
+            else:
+                cache[key] = matches[0] if matches else None
+        else:
+            cache[key] = self._check_value(
+                pattern, call(get, pid, actions), regex, all
+            )
+
+        # Hand out copies of cached lists.
+        return list(cache[key]) if all else cache[key]
+
+    def _index_values(self, values):
+        """Maps the lowercased values of a check() subject to the original
+        values, in order, so that plain string checks become a dictionary
+        lookup rather than a scan of the subject."""
+        index = {}
+        for value in values:
+            index.setdefault(value.lower(), []).append(value)
+        return index
 
     def get_results(self, key=None, default=None):
         if key:
@@ -757,13 +1127,34 @@ class Signature(object):
 
         return self._caller.results
 
+    def _get_behavior(self, key):
+        """Get a list from the behavior results, e.g., "processes".
+        @param key: behavior section.
+        @return: list of entries.
+        """
+        if key not in self._behavior:
+            behavior = self.get_results("behavior", {})
+            self._behavior[key] = behavior.get(key, [])
+        return self._behavior[key]
+
+    def _processes_by_pid(self, key):
+        """Index the entries of a behavior section by their pid.
+        @param key: behavior section, e.g., "processes" or "generic".
+        @return: dictionary mapping each pid to a list of entries.
+        """
+        if key not in self._pid_index:
+            index = self._pid_index[key] = {}
+            for item in self._get_behavior(key):
+                index.setdefault(item["pid"], []).append(item)
+        return self._pid_index[key]
+
     def get_processes(self, name=None):
         """Get a list of processes.
 
         @param name: If set only return processes with that name.
         @return: List of processes or empty list
         """
-        for item in self.get_results("behavior", {}).get("processes", []):
+        for item in self._get_behavior("processes"):
             if name is None or item["process_name"] == name:
                 yield item
 
@@ -773,9 +1164,9 @@ class Signature(object):
         @param pid: pid to search for.
         @return: process.
         """
-        for item in self.get_results("behavior", {}).get("processes", []):
-            if item["pid"] == pid:
-                return item
+        items = self._processes_by_pid("processes").get(pid)
+        if items:
+            return items[0]
 
     def get_summary(self, key=None, default=[]):
         """Get one or all values related to the global summary."""
@@ -788,15 +1179,22 @@ class Signature(object):
         @param pid: pid of the process. None for all
         @param actions: A list of actions to get
         """
-        ret = []
-        for process in self.get_results("behavior", {}).get("generic", []):
-            if pid is not None and process["pid"] != pid:
-                continue
+        return list(self._iter_summary_generic(pid, actions))
+
+    def _iter_summary_generic(self, pid, actions):
+        """Lazily iterate generic info from summary, see
+        get_summary_generic(). Allows the check_*() methods to stop at the
+        first match."""
+        if pid is None:
+            processes = self._get_behavior("generic")
+        else:
+            processes = self._processes_by_pid("generic").get(pid, [])
 
-            for action in actions:
-                if action in process["summary"]:
-                    ret += process["summary"][action]
-        return ret
+        summaries = (process["summary"] for process in processes)
+        return itertools.chain.from_iterable(
+            summary.get(action, ())
+            for summary in summaries for action in actions
+        )
 
     def get_files(self, pid=None, actions=None):
         """Get files read, queried, or written to optionally by a
@@ -808,11 +1206,7 @@ class Signature(object):
 
         """
         if actions is None:
-            actions = [
-                "file_opened", "file_written",
-                "file_read", "file_deleted",
-                "file_exists", "file_failed",
-            ]
+            actions = FILE_ACTIONS
 
         return self.get_summary_generic(pid, actions)
 
@@ -834,10 +1228,7 @@ class Signature(object):
 
         """
         if actions is None:
-            actions = [
-                "regkey_opened", "regkey_written",
-                "regkey_read", "regkey_deleted",
-            ]
+            actions = REGKEY_ACTIONS
 
         return self.get_summary_generic(pid, actions)
 
@@ -852,17 +1243,7 @@ class Signature(object):
                     processes will be checked.
         @return: boolean with the result of the check.
         """
-        if actions is None:
-            actions = [
-                "file_opened", "file_written",
-                "file_read", "file_deleted",
-                "file_exists", "file_failed",
-            ]
-
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_files(pid, actions),
-                                 regex=regex,
-                                 all=all)
+        return self.check("file", pattern, regex, all, pid, actions)
 
     def check_dll_loaded(self, pattern, regex=False, actions=None, pid=None,
                          all=False):
@@ -874,10 +1255,7 @@ class Signature(object):
                     processes will be checked.
         @return: boolean with the result of the check.
         """
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_dll_loaded(pid),
-                                 regex=regex,
-                                 all=all)
+        return self.check("dll_loaded", pattern, regex, all, pid)
 
     def check_command_line(self, pattern, regex=False, all=False):
         """Checks for a command line being opened.
@@ -886,10 +1264,7 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_summary("command_line"),
-                                 regex=regex,
-                                 all=all)
+        return self.check("command_line", pattern, regex, all)
 
     def check_key(self, pattern, regex=False, actions=None, pid=None,
                   all=False):
@@ -903,15 +1278,9 @@ class Signature(object):
         @return: boolean with the result of the check.
         """
         if actions is None:
-            actions = [
-                "regkey_written", "regkey_opened",
-                "regkey_read", "regkey_deleted",
-            ]
+            actions = CHECK_REGKEY_ACTIONS
 
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_keys(pid, actions),
-                                 regex=regex,
-                                 all=all)
+        return self.check("key", pattern, regex, all, pid, actions)
 
     def get_mutexes(self, pid=None):
         """
@@ -927,10 +1296,7 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_mutexes(),
-                                 regex=regex,
-                                 all=all)
+        return self.check("mutex", pattern, regex, all)
 
     def get_command_lines(self):
         """Retrieves all command lines used."""
@@ -945,7 +1311,10 @@ class Signature(object):
 
         @param subtype: subtype string to search for.
         """
-        return self.get_results("network", {}).get(subtype, [])
+        if subtype not in self._network:
+            network = self.get_results("network", {})
+            self._network[subtype] = network.get(subtype, [])
+        return self._network[subtype]
 
     def get_net_hosts(self):
         """Returns a list of all hosts."""
@@ -1015,10 +1384,7 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        return self._check_value(pattern=pattern,
-                                 subject=self.get_net_hosts(),
-                                 regex=regex,
-                                 all=all)
+        return self.check("ip", pattern, regex, all)
 
     def check_domain(self, pattern, regex=False, all=False):
         """Checks for a domain being contacted.
@@ -1027,14 +1393,7 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        domains = set()
-        for item in self.get_net_domains():
-            domains.add(item["domain"])
-
-        return self._check_value(pattern=pattern,
-                                 subject=list(domains),
-                                 regex=regex,
-                                 all=all)
+        return self.check("domain", pattern, regex, all)
 
     def check_url(self, pattern, regex=False, all=False):
         """Checks for a URL being contacted.
@@ -1043,14 +1402,7 @@ class Signature(object):
                       expression or not and therefore should be compiled.
         @return: boolean with the result of the check.
         """
-        urls = set()
-        for item in self.get_net_http():
-            urls.add(item["uri"])
-
-        return self._check_value(pattern=pattern,
-                                 subject=list(urls),
-                                 regex=regex,
-                                 all=all)
+        return self.check("url", pattern, regex, all)
 
     def check_suricata_alerts(self, pattern):
         """Check for pattern in Suricata alert signature
@@ -1094,9 +1446,18 @@ class Signature(object):
             "description": description,
         }
 
-        # Prevent duplicates.
-        if mark not in self.marks:
-            self.marks.append(mark)
+        # Prevent duplicates. Fall back to scanning the marks for IOCs that
+        # can't be hashed.
+        try:
+            key = category, ioc, description
+            if key in self._ioc_marks:
+                return
+            self._ioc_marks.add(key)
+        except TypeError:
+            if mark in self.marks:
+                return
+
+        self.marks.append(mark)
 
     def mark_vol(self, plugin, **kwargs):
         """Mark output of a Volatility plugin as explanation as to why the
@@ -1214,6 +1575,7 @@ class Report(object):
     def __init__(self):
         self.analysis_path = ""
         self.reports_path = ""
+        self._file_path = None
         self.task = None
         self.options = None
 
@@ -1224,12 +1586,22 @@ class Report(object):
     def _get_analysis_path(self, subpath):
         return os.path.join(self.analysis_path, subpath)
 
+    @property
+    def file_path(self):
+        """Resolved path of the analyzed binary. The realpath lookup touches
+        the filesystem, so it is only done when a reporter asks for it."""
+        if self._file_path is None:
+            self._file_path = os.path.realpath(
+                self._get_analysis_path("binary")
+            )
+        return self._file_path
+
     def set_path(self, analysis_path):
         """Set analysis folder path.
         @param analysis_path: analysis folder path.
         """
         self.analysis_path = analysis_path
-        self.file_path = os.path.realpath(self._get_analysis_path("binary"))
+        self._file_path = None
         self.reports_path = self._get_analysis_path("reports")
         self.shots_path = self._get_analysis_path("shots")
         self.pcap_path = self._get_analysis_path("dump.pcap")
@@ -165,6 +165,7 @@ class List(Type):
         self.subclass = subclass
         self.sep = sep
         self.strip = strip
+        self.split = re.compile("[%s]" % sep).split
         super(List, self).__init__(default)
 
     def parse(self, value):
@@ -172,20 +173,20 @@ class List(Type):
             return []
 
         try:
-            ret = []
+            ret, subclass = [], self.subclass()
 
             if isinstance(value, (tuple, list)):
                 for entry in value:
-                    ret.append(self.subclass().parse(entry))
+                    ret.append(subclass.parse(entry))
                 return ret
 
-            for entry in re.split("[%s]" % self.sep, value):
+            for entry in self.split(value):
                 if self.strip:
                     entry = entry.strip()
                     if not entry:
                         continue
 
-                ret.append(self.subclass().parse(entry))
+                ret.append(subclass.parse(entry))
             return ret
         except:
             log.error("Incorrect list: %s", value)
@@ -572,37 +572,83 @@ class Database(object):
         @param resultserver_ip: IP address of the Result Server
         @param resultserver_port: port of the Result Server
         """
-        if options is None:
-            options = []
-        if not isinstance(options, (tuple, list)):
-            options = options.split()
+        self.add_machines([dict(
+            name=name, label=label, ip=ip, platform=platform,
+            options=options, tags=tags, interface=interface,
+            snapshot=snapshot, resultserver_ip=resultserver_ip,
+            resultserver_port=resultserver_port,
+        )])
 
-        session = self.Session()
-        machine = Machine(name=name,
-                          label=label,
-                          ip=ip,
-                          platform=platform,
-                          options=options,
-                          interface=interface,
-                          snapshot=snapshot,
-                          resultserver_ip=resultserver_ip,
-                          resultserver_port=resultserver_port)
+    @classlock
+    def add_machines(self, machines):
+        """Add multiple guest machines in a single transaction. Should that
+        fail, the machines are added one by one and those that can't be
+        added are skipped.
+        @param machines: list of dictionaries with the keyword arguments
+                         accepted by add_machine()
+        """
+        if self._add_machines(machines):
+            return
 
-        # Deal with tags format (i.e., foo,bar,baz)
-        if tags:
-            for tag in tags.split(","):
-                if tag.strip():
-                    tag = self._get_or_create(session, Tag, name=tag.strip())
-                    machine.tags.append(tag)
-        session.add(machine)
+        # Savepoints aren't reliable with pysqlite, so find the offending
+        # machines by retrying each one in its own transaction instead.
+        for kwargs in machines:
+            if not self._add_machines([kwargs]):
+                log.warning(
+                    "Unable to add machine %s to the database, skipping it.",
+                    kwargs.get("name")
+                )
 
+    def _add_machines(self, machines):
+        """Add guest machines in a single transaction.
+        @param machines: list of add_machine() keyword argument dictionaries
+        @return: whether the transaction was committed
+        """
+        session = self.Session()
         try:
+            for kwargs in machines:
+                session.add(self._create_machine(session, kwargs))
+
+                # Machine.tags is a single_parent relationship, so a Tag
+                # instance may not be shared between machines in the same
+                # session. Flush and forget each machine so the next one
+                # loads its tags afresh; everything is committed at once.
+                session.flush()
+                session.expunge_all()
+
             session.commit()
         except SQLAlchemyError as e:
-            log.debug("Database error adding machine: {0}".format(e))
+            log.debug("Database error adding machines: {0}".format(e))
             session.rollback()
+            return False
         finally:
             session.close()
+        return True
+
+    def _create_machine(self, session, kwargs):
+        """Create a Machine object from the add_machine() arguments.
+        @param session: database session to look up the tags in
+        @param kwargs: dictionary with the add_machine() arguments
+        @return: Machine object
+        """
+        kwargs = dict(kwargs)
+        options = kwargs.pop("options", None)
+        if options is None:
+            options = []
+        if not isinstance(options, (tuple, list)):
+            options = options.split()
+
+        machine_tags = kwargs.pop("tags", None)
+        machine = Machine(options=options, **kwargs)
+
+        # Deal with tags format (i.e., foo,bar,baz)
+        if machine_tags:
+            for tag in machine_tags.split(","):
+                tag = tag.strip()
+                if tag:
+                    tag = self._get_or_create(session, Tag, name=tag)
+                    machine.tags.append(tag)
+        return machine
 
     @classlock
     def set_status(self, task_id, status):
@@ -330,6 +330,10 @@ class RunSignatures(object):
         self.results = results
         self.matched = []
 
+        # Outcome of the Signature check_*() helpers, shared between all
+        # signatures as the results don't change while they run.
+        self.check_cache = {}
+
         # Initialize each applicable Signature.
         self.signatures = []
         for signature in self.available_signatures:
@@ -428,7 +432,7 @@ class RunSignatures(object):
     def init_api_sigs(self, apiname, category):
         """Initialize a list of signatures for which we should trigger its
         on_call method for this particular API name and category."""
-        self.api_sigs[apiname] = []
+        sigs = self.api_sigs[apiname] = []
 
         for sig in self.signatures:
             if sig.filter_apinames and apiname not in sig.filter_apinames:
@@ -437,22 +441,24 @@ class RunSignatures(object):
             if sig.filter_categories and category not in sig.filter_categories:
                 continue
 
-            self.api_sigs[apiname].append(sig)
+            sigs.append(sig)
+        return sigs
 
     def yield_calls(self, proc):
         """Yield calls of interest to each interested signature."""
         for idx, call in enumerate(proc.get("calls", [])):
 
             # Initialize a list of signatures to call for this API call.
-            if call["api"] not in self.api_sigs:
-                self.init_api_sigs(call["api"], call.get("category"))
+            sigs = self.api_sigs.get(call["api"])
+            if sigs is None:
+                sigs = self.init_api_sigs(call["api"], call.get("category"))
 
             # See the following SO answer on why we're using reversed() here.
             # http://stackoverflow.com/a/10665800
-            for sig in reversed(self.api_sigs[call["api"]]):
+            for sig in reversed(sigs):
                 sig.cid, sig.call = idx, call
                 if self.call_signature(sig, sig.on_call, call, proc) is False:
-                    self.api_sigs[call["api"]].remove(sig)
+                    sigs.remove(sig)
 
     def process_yara_matches(self):
         """Yields any Yara matches to each signature."""
@@ -4,6 +4,7 @@
 
 import datetime
 import dateutil.parser
+import io
 import os
 import logging
 import re
@@ -14,22 +15,33 @@ from cuckoo.misc import cwd
 
 log = logging.getLogger(__name__)
 
-class FilteredProcessLog(list):
-    def __init__(self, eventstream, **kwfilters):
-        self.eventstream = eventstream
-        self.kwfilters = kwfilters
-
-    def __iter__(self):
-        for event in self.eventstream:
-            for k, v in self.kwfilters.items():
-                if event[k] != v:
-                    continue
-
-                del event["type"]
-                yield event
-
-    def __nonzero__(self):
-        return True
+_MONTHS = {
+    "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+    "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12,
+}
+
+# 'python@7f798cb95240[2114] close(6) = -2 (ENOENT)', where the return value
+# and error code are optional (e.g., for exit_group).
+_LINE_RE = re.compile(
+    r"\s*(?P<pname>[^@]*)@(?P<ip>[^\[]*)\[(?P<pid>[^\]]*)\]\s*"
+    r"(?P<fn>[^(]*)\((?P<args>[^)]*)\)"
+    r"(?:\s*=\s*(?P<retval>\S+)(?:\s+\((?P<ecode>[^)]*)\))?)?\s*$"
+)
+
+# Escape sequences as understood by Python's "string_escape" codec.
+_ESCAPE_RE = re.compile(r"\\(x[0-9a-fA-F]{2}|[0-7]{1,3}|[\\'\"abfnrtv\n])")
+_ESCAPES = {
+    "\\": "\\", "'": "'", "\"": "\"", "a": "\a", "b": "\b", "f": "\f",
+    "n": "\n", "r": "\r", "t": "\t", "v": "\v", "\n": "",
+}
+
+def _unescape(match):
+    seq = match.group(1)
+    if seq[0] == "x":
+        return chr(int(seq[1:], 16))
+    if seq[0] in "01234567":
+        return chr(int(seq, 8) & 0xff)
+    return _ESCAPES[seq]
 
 class LinuxSystemTap(BehaviorHandler):
     """Parses systemtap generated plaintext logs (see
@@ -37,10 +49,14 @@ class LinuxSystemTap(BehaviorHandler):
 
     key = "processes"
 
+    # Syscalls that create a new process.
+    fork_apis = frozenset(["clone", "fork", "vfork"])
+
     def __init__(self, *args, **kwargs):
         super(LinuxSystemTap, self).__init__(*args, **kwargs)
 
         self.processes = []
+        self.processes_by_pid = {}
         self.forkmap = {}
         self.behavior = {}
         self.matched = False
@@ -51,12 +67,20 @@ class LinuxSystemTap(BehaviorHandler):
             return True
 
     def parse(self, path):
-        parser = StapParser(open(path, "rb"))
-        # collect all the pids to monitor
-        for syscall in parser:
+        # Large .stap logs are read sequentially, twice; a big read buffer
+        # keeps the number of read() syscalls down.
+        with io.open(path, "rb", buffering=1024*1024) as fd:
+            for event in self._parse(StapParser(fd)):
+                yield event
+
+    def _parse(self, parser):
+        # collect all the pids to monitor, only fork-like syscalls matter
+        # for this so don't bother fully parsing every other line
+        for syscall in parser.iter_calls(apis=self.fork_apis):
             self.pre_hook(syscall)
 
-        # rebuild processes and behavior for each pid in forkmap
+        # rebuild processes and behavior for each pid in forkmap, collecting
+        # the calls of each process along the way
         for syscall in parser:
             pid = syscall["pid"]
             # skip first analyzer process
@@ -65,7 +89,6 @@ class LinuxSystemTap(BehaviorHandler):
 
             if self.is_newpid(pid):
                 p_pid = self.forkmap.get(pid, -1)
-                calls = FilteredProcessLog(parser, pid=pid)
                 process = {
                     "type": "process",
                     "pid": pid,
@@ -73,16 +96,27 @@ class LinuxSystemTap(BehaviorHandler):
                     "process_name": syscall["process_name"],
                     "first_seen": syscall["time"],
                     "command_line": "",
-                    "calls": calls,
+                    "calls": [],
                 }
                 self.processes.append(process)
+                self.processes_by_pid[pid] = process
                 self.behavior[pid] = BehaviorReconstructor()
                 #yield process
 
+            # Each call is kept in memory until the report is written, so
+            # don't hold on to the original log line as well. (For Windows
+            # analyses "raw" lists the arguments not to be prettified.)
+            del syscall["type"], syscall["raw"]
+            self.processes_by_pid[pid]["calls"].append(syscall)
+
             p = self.post_hook(syscall)
             if p:
                 yield p
 
+            # Most syscalls (mmap, brk, futex, ..) aren't reconstructed.
+            if syscall["api"] not in BehaviorReconstructor.apis:
+                continue
+
             for category, arg in self.behavior[pid].process_apicall(syscall):
                 yield {
                         "type": "generic",
@@ -92,8 +126,7 @@ class LinuxSystemTap(BehaviorHandler):
                     }
 
     def pre_hook(self, syscall):
-        fn = syscall["api"]
-        if fn == "clone" or fn == "fork" or fn == "vfork":
+        if syscall["api"] in self.fork_apis:
             self.forkmap[int(syscall["return_value"])] = syscall["pid"]
 
     def post_hook(self, syscall):
@@ -108,56 +141,65 @@ class LinuxSystemTap(BehaviorHandler):
                 return pid
 
     def get_proc(self, pid):
-        for process in self.processes:
-            if process["pid"] == pid:
-                return process
+        return self.processes_by_pid.get(pid)
 
     def is_newpid(self, pid):
-        return not any(p["pid"] == pid for p in self.processes)
+        return pid not in self.processes_by_pid
 
     def run(self):
         if not self.matched:
             return
 
-        self.processes.sort(key=lambda process: process["first_seen"])
+        # Processes are usually discovered in chronological order already.
+        first_seen = [process["first_seen"] for process in self.processes]
+        if any(a > b for a, b in zip(first_seen, first_seen[1:])):
+            self.processes.sort(key=lambda process: process["first_seen"])
         return self.processes
 
-def single(key, value):
-    return [(key, value)]
-
 def multiple(*l):
     return l
 
-class BehaviorReconstructor(object):  
+class BehaviorReconstructor(object):
     """Reconstructs the behavior of behavioral API logs."""
+
+    # APIs that have an _api_* handler below.
+    apis = frozenset([
+        "open", "write", "read", "close", "stat", "connect", "socket",
+    ])
+
+    # API name to _api_* function, filled in below the class.
+    handlers = {}
+
+    __slots__ = "files", "sockets"
+
     def __init__(self):
         self.files = {}
         self.sockets = {}
 
-
     def process_apicall(self, event):
-        fn = getattr(self, "_api_%s" % event["api"], None)
+        fn = self.handlers.get(event["api"])
         if fn is not None:
             ret = fn(
-                event["return_value"], event["arguments"], event.get("status")
+                self, event["return_value"], event["arguments"],
+                event.get("status")
             )
-            return ret or []
-        return []
+            return ret or ()
+        return ()
 
     def _api_open(self, return_value, arguments, status):
         if return_value >= 0:
             self.files[return_value] = arguments["filename"]
-            return single("file_opened", arguments["filename"])
+            return (("file_opened", arguments["filename"]),)
         else:
-            return single("file_failed", arguments["filename"])
+            return (("file_failed", arguments["filename"]),)
 
     def _api_write(self, return_value, arguments, status):
         if arguments["fd"] in self.files :
-            return single("file_writen",(self.files[arguments["fd"]]))
+            return (("file_writen", self.files[arguments["fd"]]),)
 
     def _api_read(self, return_value, arguments, status):
         if arguments["fd"] in self.files :
-            return single("file_read",(self.files[arguments["fd"]]))
+            return (("file_read", self.files[arguments["fd"]]),)
 
     def _api_close(self, return_value, arguments, status):
         if arguments["fd"] in self.files:
@@ -166,26 +208,65 @@ class BehaviorReconstructor(object):
             self.sockets.pop(arguments["fd"], None)
 
     def _api_stat(self, return_value, arguments, status):
-        return single("file_exists",(arguments["filename"]))
+        return (("file_exists", arguments["filename"]),)
 
     def _api_connect(self, return_value, arguments, flags):
-        return single("connects_ip", repr(arguments["uservaddr"]))
+        return (("connects_ip", repr(arguments["uservaddr"])),)
 
     def _api_socket(self, return_value, arguments, flags):
         self.sockets[return_value] = arguments
-        return single("socket", (arguments["type"]))
+        return (("socket", arguments["type"]),)
+
+# Map API names to their _api_* handlers once, rather than looking the handler
+# up by name for every single event.
+BehaviorReconstructor.handlers.update(
+    (api, BehaviorReconstructor.__dict__["_api_%s" % api])
+    for api in BehaviorReconstructor.apis
+)
 
 
 class StapParser(object):
     """Handle .stap logs from the Linux analyzer."""
 
+    # Maximum amount of distinct argument strings to cache.
+    args_cache_size = 4096
+
     def __init__(self, fd):
         self.fd = fd
+
+        # Timestamp (up to the second) of the last parsed line and its
+        # datetime, consecutive lines very often share the same second.
+        self.last_head = None
+        self.last_dt = None
+
+        # Parsed arguments by their raw string, many calls (e.g., reads and
+        # writes on the same fd and buffer) repeat the exact same arguments.
+        self.args_cache = {}
         with open(cwd("systemtap", "mappings.json", private=True)) as json_file:
-            self.mappings = json.load(json_file)
+            mappings = json.load(json_file)
+
+        # Turn each syscall's argument list into (positional name, real
+        # name) pairs up front so renaming doesn't have to build them. The
+        # log is read as bytestrings, so convert the unicode keys from the
+        # JSON file as well, or every lookup would implicitly decode the
+        # syscall name in order to compare it.
+        self.mappings = {}
+        for syscall, arguments in mappings.items():
+            if not syscall.startswith("sys_"):
+                continue
 
+            self.mappings[syscall[4:].encode("utf-8")] = tuple(
+                ("p%u" % idx, argument["name"].encode("utf-8"))
+                for idx, argument in enumerate(arguments)
+            )
 
     def __iter__(self):
+        return self.iter_calls()
+
+    def iter_calls(self, apis=None):
+        """Yields the parsed syscalls from the log.
+        @param apis: if set, only parse and yield syscalls with these names.
+        """
         self.fd.seek(0)
 
         for line in self.fd:
@@ -193,17 +274,24 @@ class StapParser(object):
             # datetime is 31 characters
             datetimepart, r = line[:31], line[32:]
 
-            # incredibly sophisticated date time handling
-            dtms = datetime.timedelta(0, 0, int(datetimepart.split(".", 1)[1]))
-            dt = dateutil.parser.parse(datetimepart.split(".", 1)[0]) + dtms
+            m = _LINE_RE.match(r)
+            if m:
+                pname, ip, pid, fn, args, retval, ecode = m.groups("")
+            else:
+                parts, r = [], r.strip()
+                for delim in ("@", "[", "]", "(", ")", "= ", " (", ")"):
+                    part, _, r = r.partition(delim)
+                    parts.append(part)
 
-            parts = []
-            for delim in ("@", "[", "]", "(", ")", "= ", " (", ")"):
-                part, _, r = r.strip().partition(delim)
-                parts.append(part)
+                pname, ip, pid, fn, args, _, retval, ecode = parts
+                # Only the syscall name follows whitespace, '[2114] close('.
+                fn = fn.lstrip()
 
-            pname, ip, pid, fn, args, _, retval, ecode = parts
-            arguments = self.parse_args(args)
+            if apis is not None and fn not in apis:
+                continue
+
+            dt = self.parse_datetime(datetimepart)
+            arguments = self.parse_args_cached(args)
             pid = int(pid) if pid.isdigit() else -1
 
             event = {
@@ -212,44 +300,147 @@ class StapParser(object):
                 "return_value": retval, "status": ecode, "category" : "default",
                 "type": "apicall", "raw": line,
             }
-            mapping = self.mappings.get("sys_%s" % fn, [])
-            if not mapping == []:
-                self.rename_args(event["arguments"], mapping)
+            mapping = self.mappings.get(fn)
+            if mapping:
+                self.rename_args(arguments, mapping)
 
             yield event
 
+    def parse_datetime(self, datetimepart):
+        head, _, us = datetimepart.partition(".")
+        us = int(us)
+        if head == self.last_head:
+            return self.last_dt.replace(microsecond=us)
+
+        # The timestamp has a fixed layout, 'Thu May  7 14:58:43 2015',
+        # so slice it up directly rather than having dateutil guess.
+        try:
+            dt = datetime.datetime(
+                int(head[20:24]), _MONTHS[head[4:7]], int(head[8:10]),
+                int(head[11:13]), int(head[14:16]), int(head[17:19]), us
+            )
+        except (ValueError, KeyError):
+            dt = dateutil.parser.parse(head).replace(microsecond=us)
+
+        self.last_head, self.last_dt = head, dt
+        return dt
+
+    def parse_args_cached(self, args):
+        # Only arguments without nested arrays or structs are cached, so
+        # that a shallow copy keeps the events independent of each other.
+        p_args = self.args_cache.get(args)
+        if p_args is None:
+            p_args = self.parse_args(args)
+            for value in p_args.itervalues():
+                if not isinstance(value, str):
+                    return p_args
+
+            if len(self.args_cache) >= self.args_cache_size:
+                self.args_cache.clear()
+            self.args_cache[args] = p_args
+        return dict(p_args)
+
     def parse_args(self, args):
         p_args, n_args = {}, 0
-
-        while args:
-            args = args.lstrip(", ")
-            delim = self.get_delim(args)
-            arg, _, args = args.partition(delim)
-            p_args["p%u" % n_args] = self.parse_arg(arg)
+        idx, length = 0, len(args)
+
+        # Walk the argument string by index rather than repeatedly slicing
+        # off the remainder, which copies the rest of the line every time.
+        while idx < length:
+            while idx < length and args[idx] in ", ":
+                idx += 1
+            if idx == length:
+                break
+
+            start = idx
+            end, idx = self.scan_arg_end(args, idx)
+            p_args["p%u" % n_args] = self.parse_arg(args[start:end])
             n_args += 1
 
         return p_args
 
-    def get_delim(self, argstr):
-        if self.is_array(argstr):
-            return "]"
-        elif self.is_struct(argstr):
-            return "}"
+    def scan_arg_end(self, argstr, start=0):
+        """Finds the end of the argument starting at start, taking arrays
+        and structs nested in arrays and structs into account.
+        @return: tuple of the end of the argument, excluding the closing
+                 bracket of an array or struct, and where scanning for the
+                 next argument continues.
+        """
+        length = len(argstr)
+        if self.is_array(argstr, start):
+            close = "]"
+        elif self.is_struct(argstr, start):
+            close = "}"
         else:
-            return ", "
+            end = argstr.find(", ", start)
+            if end < 0:
+                return length, length
+            return end, end + 2
+
+        # Without anything nested, the first closing bracket is the one.
+        end = argstr.find(close, start)
+        if end < 0:
+            end = length
+        if argstr.find("[", start + 1, end) < 0 and \
+                argstr.find("{", start + 1, end) < 0:
+            return end, end + 1
+
+        depth = 0
+        for idx in xrange(start, length):
+            c = argstr[idx]
+            if c == "[" or c == "{":
+                depth += 1
+            elif c == "]" or c == "}":
+                depth -= 1
+                if not depth:
+                    return idx, idx + 1
+        return length, length
 
     def parse_arg(self, argstr):
-        if self.is_array(argstr):
+        # Hot path: most arguments are plain values, so decide on the first
+        # character rather than going through the is_*() helpers each time.
+        first = argstr[:1]
+        if first == "[" and not argstr.startswith("[/*"):
             return self.parse_array(argstr)
-        elif self.is_struct(argstr):
+        elif first == "{":
             return self.parse_struct(argstr)
-        elif self.is_string(argstr):
+        elif first == "\"" and argstr.endswith("\""):
             return self.parse_string(argstr)
         else:
             return argstr
 
     def parse_array(self, argstr):
-        return [self.parse_arg(a) for a in argstr.lstrip("[").split(", ")]
+        start = 1 if argstr.startswith("[") else 0
+        end = argstr.find("]", start)
+        if end < 0:
+            end = len(argstr)
+
+        # Delimiters inside strings are escaped by the analyzer, so unless
+        # there are nested arrays or structs a plain split will do.
+        if argstr.find("[", start, end) < 0 and \
+                argstr.find("{", start, end) < 0:
+            return [
+                self.parse_arg(a) for a in argstr[start:end].split(", ")
+            ]
+
+        elements, depth = [], 0
+        idx, end = start, len(argstr)
+        while idx < end:
+            c = argstr[idx]
+            if c == "[" or c == "{":
+                depth += 1
+            elif c == "]" or c == "}":
+                if not depth:
+                    break
+                depth -= 1
+            elif c == "," and not depth and argstr.startswith(", ", idx):
+                elements.append(self.parse_arg(argstr[start:idx]))
+                start = idx = idx + 2
+                continue
+            idx += 1
+
+        elements.append(self.parse_arg(argstr[start:idx]))
+        return elements
 
     def parse_struct(self, argstr):
         # Return as regular array if elements aren't named.
@@ -259,33 +450,33 @@ class StapParser(object):
         # Return as dict, parse value as array and struct when appropriate.
         parsed = {}
         arg = argstr.lstrip("{")
+        # Structs nested in an array still have their closing brace.
+        if arg.endswith("}"):
+            arg = arg[:-1]
         while arg:
             key, _, arg = arg.partition("=")
-            delim = self.get_delim(arg)
-            if delim != ", ":
-                delim += ", "
-            val, _, arg = arg.partition(delim)
-            parsed[key] = self.parse_arg(val)
+            end, idx = self.scan_arg_end(arg)
+            parsed[key] = self.parse_arg(arg[:end])
+            arg = arg[idx:].lstrip(", ")
 
         return parsed
 
     def parse_string(self, argstr):
-        return argstr.strip("\"").decode("string_escape")
+        argstr = argstr.strip("\"")
+        if "\\" not in argstr:
+            return argstr
+        return _ESCAPE_RE.sub(_unescape, argstr)
 
-    def is_array(self, arg):
-        return arg.startswith("[") and not arg.startswith("[/*")
+    def is_array(self, arg, start=0):
+        return arg.startswith("[", start) and not arg.startswith("[/*", start)
 
-    def is_struct(self, arg):
-        return arg.startswith("{")
+    def is_struct(self, arg, start=0):
+        return arg.startswith("{", start)
 
     def is_string(self, arg):
         return arg.startswith("\"") and arg.endswith("\"")
 
     def rename_args(self, args, mapping):
-        n_args, key = 0,""
-        for newKey in mapping:
-            key = "p%u" % n_args
+        for key, name in mapping:
             if args.get(key):
-                args[newKey["name"].encode('utf-8')] = args[key]
-                del args[key]
-            n_args += 1
+                args[name] = args.pop(key)
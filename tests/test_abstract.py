@@ -26,6 +26,9 @@ class TestReport:
         rep_dir = os.path.join(dir, "reports")
         self.r.set_path(dir)
         assert os.path.exists(rep_dir)
+        assert self.r.file_path == os.path.realpath(
+            os.path.join(dir, "binary")
+        )
         os.rmdir(rep_dir)
 
     def test_options_none(self):
@@ -195,6 +195,44 @@ class DatabaseEngine(object):
         assert m3.options == ["opt1", "opt2"]
         assert m4.options == ["opt3", "opt4"]
 
+    def test_add_machines(self):
+        self.d.add_machines([dict(
+            name="name5", label="label5", ip="1.2.3.4", platform="windows",
+            options="opt1", tags="tag3,tag4", interface="int0",
+            snapshot="snap0", resultserver_ip="5.6.7.8",
+            resultserver_port=2043,
+        ), dict(
+            name="name6", label="label6", ip="1.2.3.5", platform="linux",
+            options=None, tags="tag3", interface="int0",
+            snapshot=None, resultserver_ip="5.6.7.8",
+            resultserver_port=2043,
+        )])
+        m5 = self.d.view_machine("name5")
+        m6 = self.d.view_machine("name6")
+        assert m5.options == ["opt1"]
+        assert sorted(tag.name for tag in m5.tags) == ["tag3", "tag4"]
+        assert m6.options == []
+        assert [tag.name for tag in m6.tags] == ["tag3"]
+
+    def test_add_machines_invalid(self):
+        machines = [dict(
+            name=name, label=name, ip="1.2.3.4", platform="windows",
+            options=None, tags="tag5", interface="int0", snapshot=None,
+            resultserver_ip="5.6.7.8", resultserver_port=2043,
+        ) for name in ("name7", "name8", "name9")]
+        machines[1]["ip"] = None
+
+        with mock.patch("cuckoo.core.database.log") as p:
+            self.d.add_machines(machines)
+        p.warning.assert_called_once()
+
+        assert self.d.view_machine("name7").ip == "1.2.3.4"
+        assert self.d.view_machine("name8") is None
+        assert self.d.view_machine("name9").ip == "1.2.3.4"
+        assert [tag.name for tag in self.d.view_machine("name9").tags] == [
+            "tag5",
+        ]
+
     @mock.patch("cuckoo.common.objects.magic")
     def test_add_sample(self, p):
         p.from_file.return_value = ""
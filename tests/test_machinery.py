@@ -7,7 +7,11 @@ import mock
 import pytest
 import subprocess
 import tempfile
+import threading
+import time
 
+from cuckoo.common import abstracts
+from cuckoo.common.abstracts import Machinery, LibVirtMachinery
 from cuckoo.common.config import config, Config
 from cuckoo.common.exceptions import (
     CuckooMachineError, CuckooCriticalError, CuckooMachineSnapshotError,
@@ -20,6 +24,7 @@ from cuckoo.core.init import write_cuckoo_conf
 from cuckoo.core.log import task_log_start, task_log_stop
 from cuckoo.core.startup import init_logging
 from cuckoo.machinery.esx import ESX
+from cuckoo.machinery.kvm import KVM
 from cuckoo.machinery.virtualbox import VirtualBox
 from cuckoo.main import cuckoo_create
 from cuckoo.misc import set_cwd, cwd, mkdir
@@ -652,6 +657,189 @@ class TestBrokenMachine(object):
             stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True
         )
 
+    def test_initialize_check_stop(self):
+        class machine(object):
+            def __init__(self, label):
+                self.label = label
+
+        self.m.db.list_machines.return_value = [
+            machine("a"), machine("b"), machine("c"),
+        ]
+        self.m._list = mock.MagicMock(return_value=["a", "b", "c"])
+        self.m._status = mock.MagicMock(side_effect=lambda label: {
+            "a": self.m.POWEROFF, "b": self.m.RUNNING, "c": self.m.RUNNING,
+        }[label])
+        self.m.stop = mock.MagicMock()
+
+        Machinery._initialize_check(self.m)
+        assert sorted(
+            args[0][0] for args in self.m.stop.call_args_list
+        ) == ["b", "c"]
+
+        self.m.stop.side_effect = CuckooMachineError("error!")
+        with pytest.raises(CuckooCriticalError) as e:
+            Machinery._initialize_check(self.m)
+        e.match("Unable to shut 'b' down")
+
+    def test_initialize_check_stop_error(self):
+        class machine(object):
+            def __init__(self, label):
+                self.label = label
+
+        self.m.db.list_machines.return_value = [
+            machine("a"), machine("b"), machine("c"),
+        ]
+        self.m._list = mock.MagicMock(return_value=[])
+        self.m.stop = mock.MagicMock(side_effect=KeyError("c"))
+
+        # Errors other than CuckooMachineError are raised as-is, regardless
+        # of the number of machines that are stopped concurrently.
+        for stop_threads in (1, 2, 8):
+            self.m.stop_threads = stop_threads
+            with pytest.raises(KeyError):
+                Machinery._initialize_check(self.m)
+
+        def stop(label):
+            if label == "b":
+                raise CuckooMachineError("error!")
+            if label == "c":
+                raise CuckooCriticalError("error!")
+
+        self.m.stop.side_effect = stop
+        with pytest.raises(CuckooCriticalError) as e:
+            Machinery._initialize_check(self.m)
+        e.match("Unable to shut 'b' down")
+
+    def test_set_status_unchanged(self):
+        self.m.set_status("label", self.m.RUNNING)
+        self.m.set_status("label", self.m.RUNNING)
+        self.m.set_status("label", self.m.POWEROFF)
+        assert self.m.db.set_machine_status.call_args_list == [
+            mock.call("label", self.m.RUNNING),
+            mock.call("label", self.m.POWEROFF),
+        ]
+
+class libvirtError(Exception):
+    pass
+
+class TestLibVirt(object):
+    def setup(self):
+        set_cwd(tempfile.mkdtemp())
+        Folders.create(cwd(), "conf")
+        write_cuckoo_conf()
+
+        self.patches = [
+            mock.patch("cuckoo.common.abstracts.HAVE_LIBVIRT", True),
+            mock.patch("cuckoo.common.abstracts.libvirt", create=True),
+            mock.patch.object(LibVirtMachinery, "_start_event_loop"),
+        ]
+        for patch in self.patches:
+            patch.start()
+        abstracts.libvirt.libvirtError = libvirtError
+
+        with mock.patch("cuckoo.common.abstracts.Database"):
+            self.m = KVM()
+
+        self.conn = abstracts.libvirt.open.return_value
+        self.domain = mock.MagicMock()
+        self.domain.state.return_value = 1, 0
+        self.m.vms = {"a": self.domain}
+        self.m._conn = self.conn
+
+    def teardown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def lifecycle_event(self, state):
+        self.domain.state.return_value = state, 0
+        self.m._lifecycle_event(self.conn, self.domain, 0, 0, "a")
+
+    def test_wait_status_event(self):
+        self.m._register_events("a", self.domain)
+        assert self.conn.domainEventRegisterAny.call_args[0][3] == "a"
+
+        threading.Timer(0.1, self.lifecycle_event, (5,)).start()
+        t = time.time()
+        self.m._wait_status("a", self.m.POWEROFF)
+        assert time.time() - t < 1
+
+    def test_wait_status_event_during_state(self):
+        self.m._register_events("a", self.domain)
+
+        # The event fires while the previous state is being retrieved, which
+        # must not be cached.
+        def state(flags):
+            self.lifecycle_event(5)
+            return 1, 0
+
+        self.domain.state.side_effect = state
+        threading.Timer(0.1, setattr, (
+            self.domain.state, "side_effect", None
+        )).start()
+        t = time.time()
+        self.m._wait_status("a", self.m.POWEROFF)
+        assert time.time() - t < 1
+
+    @mock.patch("cuckoo.common.abstracts.config")
+    def test_wait_status_timeout(self, p):
+        p.return_value = 0.2
+        self.m._register_events("a", self.domain)
+        with pytest.raises(CuckooMachineError) as e:
+            self.m._wait_status("a", self.m.POWEROFF)
+        e.match("Timeout hit")
+
+    @mock.patch.object(Machinery, "_wait_status")
+    def test_wait_status_polling(self, p):
+        self.conn.domainEventRegisterAny.side_effect = libvirtError
+        self.m._register_events("a", self.domain)
+        assert "a" not in self.m._events
+
+        self.m._wait_status("a", self.m.POWEROFF)
+        p.assert_called_once_with("a", self.m.POWEROFF)
+
+    def test_reconnect(self):
+        class machine(object):
+            label = "a"
+
+        self.m.db.list_machines.return_value = [machine()]
+        self.m._conn = None
+        self.m.vms = None
+        self.m.vms = self.m._fetch_machines()
+        self.m._register_events("a", self.domain)
+        event = self.m._events["a"]
+
+        # libvirtd goes away.
+        closed = self.conn.registerCloseCallback.call_args[0][0]
+        closed(self.conn, 0, None)
+        assert self.m._conn is None
+        assert event.is_set()
+
+        conn2, domain2 = mock.MagicMock(), mock.MagicMock()
+        domain2.name.return_value = "a"
+        domain2.state.return_value = 5, 0
+        conn2.listAllDomains.return_value = [domain2]
+
+        # libvirtd is still starting up the first time around.
+        conn1 = mock.MagicMock()
+        conn1.listAllDomains.side_effect = libvirtError
+        abstracts.libvirt.open.side_effect = conn1, conn2
+
+        with pytest.raises(CuckooMachineError):
+            self.m._status("a")
+        assert self.m._conn is None
+        conn1.close.assert_called_once()
+
+        assert self.m._status("a") == self.m.POWEROFF
+        assert self.m._conn is conn2
+        assert self.m.vms == {"a": domain2}
+        assert self.m._events["a"] is event
+        conn2.registerCloseCallback.assert_called_once()
+        assert conn2.domainEventRegisterAny.call_args[0][0] is domain2
+
+        # Callbacks of the old connection are ignored.
+        closed(self.conn, 0, None)
+        assert self.m._conn is conn2
+
 def test_esx_not_installed():
     with pytest.raises(CuckooDependencyError) as e:
         ESX()
@@ -881,6 +881,13 @@ class TestBehavior(object):
         result["generic"][2]["summary"] = []
         result["processtree"][0]["summary"] = []
 
+        # Same goes for the calls, just check which process they belong to.
+        for process in result["processes"]:
+            assert process["calls"]
+            for call in process["calls"]:
+                assert call["pid"] == process["pid"]
+            process["calls"] = []
+
         assert result["generic"] == [{
                 "first_seen": datetime.datetime(2017, 8, 28, 14, 29, 32, 618541),
                 "pid": 820,
@@ -303,6 +303,202 @@ def test_mark_config():
         }],
     }
 
+@mock.patch.object(Signature, "_regex_cache", {})
+def test_patterns_init_once():
+    class sig(Signature):
+        name = "foobar"
+        patterns = [
+            "foo.*", "invalid(",
+        ]
+
+    sig.init_once()
+    assert sorted(sig._compiled_patterns) == ["foo.*"]
+    assert Signature._compiled_patterns == {}
+
+    s = sig(None)
+    assert s._check_value("foo.*", "FOOBAR", regex=True) == "FOOBAR"
+    assert Signature._regex_cache == {}
+
+def test_mark_ioc_duplicates():
+    class sig(Signature):
+        name = "foobar"
+
+    s = sig(None)
+    s.mark_ioc("file", "a.exe")
+    s.mark_ioc("file", "a.exe")
+    s.mark_ioc("file", "a.exe", "description")
+    s.mark_ioc("registry", ["a", "b"])
+    s.mark_ioc("registry", ["a", "b"])
+    assert s.marks == [{
+        "type": "ioc",
+        "category": "file",
+        "ioc": "a.exe",
+        "description": None,
+    }, {
+        "type": "ioc",
+        "category": "file",
+        "ioc": "a.exe",
+        "description": "description",
+    }, {
+        "type": "ioc",
+        "category": "registry",
+        "ioc": ["a", "b"],
+        "description": None,
+    }]
+
+def test_check_value():
+    class sig(Signature):
+        name = "foobar"
+
+    s = sig(None)
+    assert s._check_value("foo", "foo") == "foo"
+    assert s._check_value("foo", "FOO") is None
+    assert s._check_value("foo", ["bar", "FOO", "foo"]) == "FOO"
+    assert sorted(s._check_value(
+        "foo", ["bar", "FOO", "foo", "foo"], all=True
+    )) == ["FOO", "foo"]
+    assert s._check_value("foo", [], all=True) == []
+
+@mock.patch.object(Signature, "_regex_cache", {})
+def test_check_value_regex():
+    class sig(Signature):
+        name = "foobar"
+
+    s = sig(None)
+    assert s._check_value("foo.*", "FOOBAR", regex=True) == "FOOBAR"
+    assert s._check_value("foo.*", "barfoo", regex=True) is None
+    assert sorted(s._check_value(
+        "foo.*", ["foo1", "bar", "Foo2"], regex=True, all=True
+    )) == ["Foo2", "foo1"]
+    assert "foo.*" in Signature._regex_cache
+
+    patterns = ["foo\\d", "bar$"]
+    assert sorted(s._check_value(
+        patterns, ["foo1", "foo", "BAR", "bar2"], regex=True, all=True
+    )) == ["BAR", "foo1"]
+    assert ("foo\\d", "bar$") in Signature._regex_cache
+
+@mock.patch.object(Signature, "regex_cache_size", 2)
+@mock.patch.object(Signature, "_regex_cache", {})
+def test_check_value_regex_cache_size():
+    class sig(Signature):
+        name = "foobar"
+
+    s = sig(None)
+    s._check_value("a", "a", regex=True)
+    s._check_value("b", "b", regex=True)
+    assert sorted(Signature._regex_cache) == ["a", "b"]
+    s._check_value("c", "c", regex=True)
+    assert sorted(Signature._regex_cache) == ["c"]
+
+def test_get_by_pid():
+    class sig(Signature):
+        name = "foobar"
+
+    rs = RunSignatures({
+        "behavior": {
+            "processes": [{
+                "pid": 1, "process_name": "a.exe",
+            }, {
+                "pid": 2, "process_name": "b.exe",
+            }],
+            "generic": [{
+                "pid": 1, "summary": {"file_written": ["a.txt"]},
+            }, {
+                "pid": 2, "summary": {"file_written": ["b.txt"]},
+            }],
+        },
+    })
+    s = sig(rs)
+    assert s.get_process_by_pid(2)["process_name"] == "b.exe"
+    assert s.get_process_by_pid(3) is None
+    assert s.get_files(pid=1) == ["a.txt"]
+    assert s.get_files(pid=3) == []
+    assert s.get_files() == ["a.txt", "b.txt"]
+    assert s.check_file("B.TXT") == "b.txt"
+    assert s.check_file(".*\\.txt$", regex=True, pid=2) == "b.txt"
+    assert sorted(s.check_file(".*\\.txt$", regex=True, all=True)) == [
+        "a.txt", "b.txt",
+    ]
+    assert s.check_file("c.txt") is None
+
+def test_check_key_order():
+    class sig(Signature):
+        name = "foobar"
+
+    s = sig(RunSignatures({
+        "behavior": {
+            "generic": [{
+                "pid": 1, "summary": {
+                    "regkey_opened": ["HKEY_A\\Opened"],
+                    "regkey_written": ["HKEY_A\\Written"],
+                },
+            }],
+        },
+    }))
+    assert s.get_keys() == ["HKEY_A\\Opened", "HKEY_A\\Written"]
+    assert s.check_key("hkey_a.*", regex=True) == "HKEY_A\\Written"
+    assert s.check_key(
+        "hkey_a.*", regex=True, actions=["regkey_opened"]
+    ) == "HKEY_A\\Opened"
+
+def test_check_network():
+    class sig(Signature):
+        name = "foobar"
+
+    rs = RunSignatures({
+        "network": {
+            "hosts": ["1.2.3.4"],
+            "domains": [{
+                "domain": "a.com", "ip": "1.2.3.4",
+            }, {
+                "domain": "b.com", "ip": "1.2.3.4",
+            }, {
+                "domain": "b.com", "ip": "1.2.3.5",
+            }],
+            "http": [{
+                "uri": "http://a.com/1",
+            }, {
+                "uri": "http://b.com/1",
+            }],
+        },
+    })
+    s = sig(rs)
+    assert s.check_ip("1.2.3.4") == "1.2.3.4"
+    assert s.check_domain("B.COM") == "b.com"
+    assert s.check_domain("b.com", all=True) == ["b.com"]
+    assert sorted(s.check_domain(".*\\.com", regex=True, all=True)) == [
+        "a.com", "b.com",
+    ]
+    assert s.check_url("http://b.com/.*", regex=True) == "http://b.com/1"
+    assert s.check_url("http://c.com/") is None
+    assert s.check("url", "http://a.com/1") == "http://a.com/1"
+
+    # The outcome is shared with other signatures of the same analysis.
+    rs.results["network"]["domains"] = []
+    assert sig(rs).check_domain("B.COM") == "b.com"
+    assert sig(RunSignatures(rs.results)).check_domain("B.COM") is None
+
+    # Unless they provide their own values.
+    class sig2(Signature):
+        name = "foobar2"
+
+        def get_net_domains(self):
+            return [{"domain": "c.com"}]
+
+    class sig3(Signature):
+        name = "foobar3"
+
+        _check_subjects = dict(Signature._check_subjects, domain=(
+            "get_net_hosts", lambda get, pid, actions: get(),
+        ))
+
+    assert sig2(rs).check_domain("B.COM") is None
+    assert sig2(rs).check_domain("C.COM") == "c.com"
+    assert sig(rs).check_domain("C.COM") is None
+    assert sig3(rs).check_domain("1.2.3.4") == "1.2.3.4"
+    assert sig(rs).check_domain("B.COM") == "b.com"
+
 def test_on_yara():
     set_cwd(os.path.realpath(tempfile.mkdtemp()))
     cuckoo_create()
@@ -3,6 +3,7 @@
 # See the file "docs/LICENSE" for copying permission.
 
 import datetime
+import io
 
 from cuckoo.processing.platform.linux import StapParser, LinuxSystemTap
 from cuckoo.processing.behavior import BehaviorAnalysis
@@ -11,7 +12,17 @@ def test_stap_behavior():
     ba = BehaviorAnalysis()
     systemTap = LinuxSystemTap(ba)
     result = list(systemTap.parse("tests/files/log_fork.stap"))
-    assert result == list([{'calls': [],
+    calls = result[0].pop("calls")
+    assert [call["api"] for call in calls] == [
+        "execve", "ioctl", "ioctl", "prctl", "time", "getpid", "time",
+        "getpid", "brk", "brk", "open", "open", "socket", "connect",
+        "getsockname", "open", "read", "close", "ioctl", "close", "fork",
+        "wait4", "write", "exit",
+    ]
+    assert all(call["pid"] == 1523 for call in calls)
+    assert all("type" not in call for call in calls)
+    assert all("raw" not in call for call in calls)
+    assert result == list([{
         'command_line': '/tmp/wget',
         'first_seen': datetime.datetime(2017, 11, 17, 6, 57, 11, 420041),
         'pid': 1523,
@@ -47,6 +58,70 @@ def test_stap_forks():
     assert len(systemTap.forkmap) == 3
     assert len(systemTap.forkmap) == len(systemTap.processes)
 
+def test_stap_parse_datetime():
+    parser = StapParser(open("tests/files/log.stap"))
+    assert parser.parse_datetime("Tue Aug  8 13:05:42 2017.464622") == \
+        datetime.datetime(2017, 8, 8, 13, 5, 42, 464622)
+    assert parser.parse_datetime("Mon Aug 28 14:29:32 2017.619873") == \
+        datetime.datetime(2017, 8, 28, 14, 29, 32, 619873)
+    assert parser.parse_datetime("Mon Aug 28 14:29:32 2017.000042") == \
+        datetime.datetime(2017, 8, 28, 14, 29, 32, 42)
+
+    # Not the expected fixed layout, handled by dateutil instead.
+    assert parser.parse_datetime("Tue Aug 8 13:05:42 2017.000001") == \
+        datetime.datetime(2017, 8, 8, 13, 5, 42, 1)
+
+def test_stap_iter_calls_apis():
+    parser = StapParser(open("tests/files/log.stap"))
+    calls = list(parser.iter_calls(apis=["write", "wait4"]))
+    assert [call["api"] for call in calls] == [
+        "write", "wait4", "write", "write",
+    ]
+    assert calls == [
+        call for call in parser if call["api"] in ("write", "wait4")
+    ]
+
+def test_stap_parse_array():
+    parser = StapParser(open("tests/files/log.stap"))
+    assert parser.parse_array("[\"a\", \"b\"") == ["a", "b"]
+    assert parser.parse_array("[a, [b, c], d]") == ["a", ["b", "c"], "d"]
+    assert parser.parse_array("[{a=1, b=2}, {c=3}]") == [
+        {"a": "1", "b": "2"}, {"c": "3"},
+    ]
+
+def test_stap_parse_args_nested():
+    parser = StapParser(open("tests/files/log.stap"))
+    assert parser.parse_args("[a, [b, c], d], 1") == {
+        "p0": ["a", ["b", "c"], "d"], "p1": "1",
+    }
+    assert parser.parse_args("{a={b=1, c=2}, d=3}, 1") == {
+        "p0": {"a": {"b": "1", "c": "2"}, "d": "3"}, "p1": "1",
+    }
+    assert parser.parse_args("{a={b={c=1}, d=[2, 3]}, e=4}") == {
+        "p0": {"a": {"b": {"c": "1"}, "d": ["2", "3"]}, "e": "4"},
+    }
+
+    parser = StapParser(io.BytesIO(
+        "Thu May  7 14:58:43 2015.390178 python@7f798cb95240[2114] "
+        "foo([a, [b, c], d], {a={b=1, c=2}, d=3}, 1) = 0\n"
+    ))
+    assert [call["arguments"] for call in parser] == [{
+        "p0": ["a", ["b", "c"], "d"],
+        "p1": {"a": {"b": "1", "c": "2"}, "d": "3"},
+        "p2": "1",
+    }]
+
+def test_stap_parse_args_cached():
+    parser = StapParser(open("tests/files/log.stap"))
+    args = parser.parse_args_cached("1, 0x800665c0, 8192")
+    assert args == {"p0": "1", "p1": "0x800665c0", "p2": "8192"}
+
+    # Renaming the arguments of one call doesn't affect the next one.
+    args["fd"] = args.pop("p0")
+    assert parser.parse_args_cached("1, 0x800665c0, 8192") == {
+        "p0": "1", "p1": "0x800665c0", "p2": "8192",
+    }
+
 def test_stap_log():
     assert list(StapParser(open("tests/files/log.stap"))) == [{
         "api": "execve",
@@ -311,7 +386,7 @@ def test_stap_log():
                     "SIGUSR2|SIGALRM|SIGTERM|SIGCHLD|SIGCONT|SIGSTOP|"
                     "SIGTSTP|SIGTTIN|SIGTTOU|SIGURG|SIGXCPU|SIGXFSZ|"
                     "SIGVTALRM|SIGPROF|SIGWINCH|SIGIO/SIGPOLL|SIGPWR|"
-                    "SIGSYS]"
+                    "SIGSYS"
                 ],
             ],
             "oact": "0x0",